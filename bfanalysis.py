@@ -0,0 +1,221 @@
+"""
+bfanalysis.py
+
+Static analysis of brainfuck programs, used to settle the fitness of doomed
+chromosomes without running an interpreter.
+
+Programs are classified as:
+    INVALID   => unbalanced brackets
+    NO_OUTPUT => contains no '.', so it can only ever produce empty output
+    HANGS     => provably enters a loop that can never exit
+    RUNNABLE  => anything else
+
+The analysis only makes claims that hold for both brainfuck.evaluate and
+cbrainfuck.evaluate, whose semantics differ at the edges (cell wrapping, the
+left end of the tape, the tape and output size limits of cbrainfuck, and
+input read from after a '!'). When it is unsure it answers RUNNABLE.
+
+"""
+
+from brainfuck import cleanup
+
+INVALID = "invalid"
+NO_OUTPUT = "no output"
+HANGS = "hangs"
+RUNNABLE = "runnable"
+
+TAPE_LIMIT = 255  # cbrainfuck halts when the pointer moves past this many cells
+OUTPUT_LIMIT = 4096  # cbrainfuck output buffer size
+
+
+def analyze(code):
+    """Classify a program without running it
+
+    Returns (status, output). output is the exact output of the program if
+    it can be worked out statically (e.g. straight-line code with no loops
+    or input), otherwise None.
+    """
+    # '!' starts the input section in cbrainfuck but is ignored by
+    # brainfuck, and cbrainfuck stops reading code at NUL or non-ASCII bytes
+    if any(c == "!" or not 0 < ord(c) < 128 for c in code):
+        return RUNNABLE, None
+
+    code = "".join(cleanup(code))
+    bracemap = match_brackets(code)
+    if bracemap is None:
+        return INVALID, None
+    if "." not in code:
+        return NO_OUTPUT, ""
+    return _simulate(code, bracemap)
+
+
+def match_brackets(code):
+    """Return a map between matching bracket positions, None if unbalanced"""
+    stack, bracemap = [], {}
+    for position, command in enumerate(code):
+        if command == "[":
+            stack.append(position)
+        elif command == "]":
+            if not stack:
+                return None
+            start = stack.pop()
+            bracemap[start] = position
+            bracemap[position] = start
+    if stack:
+        return None
+    return bracemap
+
+
+def _loop_effect(code, bracemap, start, end):
+    """Summarize what one pass over code[start:end] does to the tape
+
+    Returns (shift, low, high, delta, written) where shift is the net
+    pointer movement, low/high the extreme pointer offsets visited, delta
+    the exact change to each cell offset by straight-line code, and written
+    the offsets changed by nested loops or input. Returns None if the
+    pointer movement depends on the data (a nested loop that moves it).
+    """
+    offset = low = high = 0
+    delta = {}
+    written = set()
+    position = start
+    while position < end:
+        command = code[position]
+        if command == "+":
+            delta[offset] = delta.get(offset, 0) + 1
+        elif command == "-":
+            delta[offset] = delta.get(offset, 0) - 1
+        elif command == ">":
+            offset += 1
+            high = max(high, offset)
+        elif command == "<":
+            offset -= 1
+            low = min(low, offset)
+        elif command == ",":
+            written.add(offset)
+        elif command == "[":
+            close = bracemap[position]
+            inner = _loop_effect(code, bracemap, position + 1, close)
+            if inner is None or inner[0] != 0:
+                return None
+            _, inner_low, inner_high, inner_delta, inner_written = inner
+            low = min(low, offset + inner_low)
+            high = max(high, offset + inner_high)
+            written.add(offset)
+            written.update(offset + o for o in inner_delta)
+            written.update(offset + o for o in inner_written)
+            position = close
+        position += 1
+    return offset, low, high, delta, written
+
+
+def _simulate(code, bracemap):
+    """Abstractly run a balanced program from its start
+
+    Cells hold their exact (unwrapped) value or None if unknown.
+    """
+    tape = {}
+    ptr = 0
+    output = []
+    exact = True
+
+    position = 0
+    while position < len(code):
+        command = code[position]
+        if command in "+-":
+            value = tape.get(ptr, 0)
+            if value is not None:
+                tape[ptr] = value + 1 if command == "+" else value - 1
+        elif command == ">":
+            if ptr + 1 >= TAPE_LIMIT:
+                return RUNNABLE, None
+            ptr += 1
+        elif command == "<":
+            if ptr == 0:
+                return RUNNABLE, None
+            ptr -= 1
+        elif command == ".":
+            value = tape.get(ptr, 0)
+            if value is None:
+                exact = False
+            else:
+                output.append(chr(value % 256))
+        elif command == ",":
+            return RUNNABLE, None
+        elif command == "[":
+            close = bracemap[position]
+            value = tape.get(ptr, 0)
+            if value == 0:  # loop is skipped
+                position = close + 1
+                continue
+
+            effect = _loop_effect(code, bracemap, position + 1, close)
+            if effect is None:
+                return RUNNABLE, None
+            shift, low, high, delta, written = effect
+            if ptr + low < 0 or ptr + high >= TAPE_LIMIT:
+                return RUNNABLE, None
+
+            # a multiple of 256 is zero to brainfuck but not to cbrainfuck
+            if (value is not None and value % 256 != 0 and shift == 0
+                    and delta.get(0, 0) == 0 and 0 not in written):
+                return HANGS, None
+            if shift != 0:
+                return RUNNABLE, None
+
+            # the loop may or may not run (or end), but if execution gets
+            # past it the current cell is zero
+            for offset in set(delta) | written:
+                tape[ptr + offset] = None
+            tape[ptr] = 0
+            exact = False
+            position = close + 1
+            continue
+        position += 1
+
+    if exact and len(output) <= OUTPUT_LIMIT:
+        return RUNNABLE, "".join(output)
+    return RUNNABLE, None
+
+
+class Prescreener():
+
+    """Assigns fitness to doomed programs so they are never interpreted
+
+    Pass an instance as the prescreen_func of a GeneticAlgorithm. Counts of
+    each status seen are kept in the counts attribute.
+
+    """
+
+    def __init__(self, invalid_fitness, empty_fitness, output_fitness=None):
+        """
+        invalid_fitness:
+            fitness given to programs with unbalanced brackets
+
+        empty_fitness:
+            fitness given to programs that can only produce empty output,
+            either because they never print or because they hang
+
+        output_fitness (function):
+            if given, it is called with the exact output of programs whose
+            output is known statically and returns their fitness
+
+        """
+        self.invalid_fitness = invalid_fitness
+        self.empty_fitness = empty_fitness
+        self.output_fitness = output_fitness
+        self.counts = dict.fromkeys((INVALID, NO_OUTPUT, HANGS, RUNNABLE), 0)
+
+    def __call__(self, chromo):
+        """Return True if chromo still needs to be evaluated"""
+        status, output = analyze(chromo.s)
+        self.counts[status] += 1
+        if status == INVALID:
+            chromo.fitness = self.invalid_fitness
+        elif status in (NO_OUTPUT, HANGS):
+            chromo.fitness = self.empty_fitness
+        elif output is not None and self.output_fitness is not None:
+            chromo.fitness = self.output_fitness(output)
+        else:
+            return True
+        return False
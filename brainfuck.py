@@ -20,7 +20,10 @@ def execute(input_file,use_string=0):
         return ans
 
 
-def evaluate(code, input_buffer=None, timeout=5):
+COMMANDS = ['.', ',', '[', ']', '<', '>', '+', '-']
+
+
+def evaluate(code, input_buffer=None, timeout=5, detect_cycles=False, profile=False):
     """
     Modified brainfuck interpreter based on https://github.com/pocmo/Python-Brainfuck/blob/master/brainfuck.py
 
@@ -33,19 +36,80 @@ def evaluate(code, input_buffer=None, timeout=5):
 
     if input_buffer is not None, it will treat it as stdin
 
+    If detect_cycles is set, the machine state is checked each time a loop
+    jumps back to its start, and None is returned as soon as a state
+    repeats (the program can never halt) instead of waiting for the timeout.
+
+    If profile is set, returns (output, stats) instead; see profile_evaluate.
+    Both are built from the same interpreter loop source, but the profiling
+    counters are only compiled into the profiled copy, so they cost nothing
+    when profiling is off.
+
     """
-    output = ""
+    if profile:
+        return profile_evaluate(code, input_buffer, timeout, detect_cycles)
+
+    code = cleanup(list(code))
+    return run(code, buildbracemap(code), input_buffer, timeout, detect_cycles)[0]
+
+
+def profile_evaluate(code, input_buffer=None, timeout=5, detect_cycles=False):
+    """
+    Same as evaluate, but also counts what the program does.
+
+    Returns (output, stats) where stats is a dict with:
+        opcodes => {command: times executed}
+        loops => {(open, close): iterations} for each bracket pair whose body
+                 ran, with positions indexing the original code string
+        tape_extent => number of cells used
+        steps => total commands executed
+
+    stats are returned even if the program timed out or diverged. The same
+    format is produced by cbrainfuck.evaluate(..., profile=True); Profile
+    aggregates them.
+
+    """
+    positions = [i for i, command in enumerate(code) if command in COMMANDS]
     code = cleanup(list(code))
     bracemap = buildbracemap(code)
+    opcodes = dict.fromkeys(COMMANDS, 0)
+    iterations = {}
+
+    output, cells = run_profiled(code, bracemap, input_buffer, timeout, detect_cycles,
+                                 opcodes, iterations)
+    return output, {"opcodes": opcodes,
+                    "loops": dict(((positions[start], positions[bracemap[start]]), count)
+                                  for start, count in iterations.items()
+                                  if start in bracemap),
+                    "tape_extent": len(cells),
+                    "steps": sum(opcodes.values())}
+
+
+# Interpreter loop shared by evaluate and profile_evaluate. Like
+# cbrainfuck's brainfuck_run.h it is built twice: run() without the lines
+# marked PROFILE and run_profiled() without the lines marked PLAIN, so
+# profiling costs nothing when it is off.
+#
+# code is a cleaned up list of commands and bracemap its bracket map; both
+# return (output, cells), with output as evaluate returns it. run_profiled
+# also adds the times each command ran to opcodes, and the iterations of
+# each loop, keyed by the position of its '[' in code, to iterations.
+_RUN_SOURCE = """
+def run(code, bracemap, input_buffer=None, timeout=5, detect_cycles=False):  # PLAIN
+def run_profiled(code, bracemap, input_buffer, timeout, detect_cycles, opcodes, iterations):  # PROFILE
+    output = ""
     cells, codeptr, cellptr = [0], 0, 0
 
     if input_buffer != None:
         input_buffer = list(input_buffer)
 
+    history = {}
+
     start = time.time()
     while (time.time() - start < timeout):
         if(codeptr < len(code)):
             command = code[codeptr]
+            opcodes[command] += 1  # PROFILE
             if command == ">":
                 cellptr += 1
                 if cellptr == len(cells):
@@ -56,10 +120,16 @@ def evaluate(code, input_buffer=None, timeout=5):
                 cells[cellptr] = cells[cellptr] + 1 if cells[cellptr] < 255 else 0
             if command == "-":
                 cells[cellptr] = cells[cellptr] - 1 if cells[cellptr] > 0 else 255
-            if command == "[" and cells[cellptr] == 0:
-                codeptr = bracemap[codeptr]
+            if command == "[":
+                if cells[cellptr] == 0:
+                    codeptr = bracemap[codeptr]
+                else:  # PROFILE
+                    iterations[codeptr] = iterations.get(codeptr, 0) + 1  # PROFILE
             if command == "]" and cells[cellptr] != 0:
+                if detect_cycles and repeated_state(history, codeptr, cellptr, cells, input_buffer):
+                    return None, cells
                 codeptr = bracemap[codeptr]
+                iterations[codeptr] += 1  # PROFILE
             if command == ".":
                 output += chr(cells[cellptr])
             if command == ",":
@@ -67,12 +137,93 @@ def evaluate(code, input_buffer=None, timeout=5):
                     cells[cellptr] = ord(input_buffer.pop(0))
             codeptr += 1
         else:
-            return output
-    return ""
+            return output, cells
+    return "", cells
+"""
+
+
+def _build_run(drop):
+    """Compile _RUN_SOURCE without the lines marked drop"""
+    lines = [line for line in _RUN_SOURCE.splitlines() if not line.endswith("# " + drop)]
+    exec(compile("\n".join(lines), "<brainfuck run %s>" % drop, "exec"), globals())
+
+
+_build_run("PROFILE")
+_build_run("PLAIN")
+
+
+class Profile():
+
+    """Aggregates profiling stats across many programs
+
+    Loops are aggregated by their source text, so the same loop showing up
+    in different programs (e.g. "[-]") is counted together.
+
+    """
+
+    def __init__(self):
+        self.programs = 0
+        self.steps = 0
+        self.max_steps = 0
+        self.tape_extent = 0
+        self.opcodes = dict.fromkeys(COMMANDS, 0)
+        self.loops = {}
+
+    def add(self, code, stats):
+        """Add the stats returned for one evaluation of code"""
+        self.programs += 1
+        self.steps += stats["steps"]
+        self.max_steps = max(self.max_steps, stats["steps"])
+        self.tape_extent = max(self.tape_extent, stats["tape_extent"])
+        for command, count in stats["opcodes"].items():
+            self.opcodes[command] = self.opcodes.get(command, 0) + count
+        for (start, end), count in stats["loops"].items():
+            loop = "".join(cleanup(code[start:end + 1]))
+            self.loops[loop] = self.loops.get(loop, 0) + count
+
+    def hot_loops(self, n=10):
+        """Return the n loops with the most iterations as (loop, iterations)"""
+        return sorted(self.loops.items(), key=lambda x: x[1], reverse=True)[:n]
+
+    def report(self, n=10):
+        """Return a printable summary"""
+        lines = ["Programs: %d" % self.programs,
+                 "Steps: %d total, %.1f average, %d max" % (
+                     self.steps, self.steps / max(self.programs, 1), self.max_steps),
+                 "Max tape extent: %d" % self.tape_extent,
+                 "Opcodes:"]
+        for command, count in sorted(self.opcodes.items(), key=lambda x: x[1], reverse=True):
+            lines.append("\t%s %d (%.1f%%)" % (command, count, 100. * count / max(self.steps, 1)))
+        lines.append("Hot loops:")
+        for loop, count in self.hot_loops(n):
+            lines.append("\t%d %s" % (count, loop))
+        return "\n".join(lines)
+
+
+def repeated_state(history, codeptr, cellptr, cells, input_buffer):
+    """Check for a repeated machine state at a loop's back edge
+
+    Uses Brent's algorithm: the state saved for each loop is replaced after
+    1, 2, 4, ... further iterations, so a cycle of any length is found
+    within a few repetitions while only rarely copying the tape.
+    """
+    remaining = len(input_buffer) if input_buffer else 0
+    saved = history.get(codeptr)
+    if saved is None:
+        limit = 1
+    else:
+        if saved[0] == cellptr and saved[2] == remaining and saved[1] == cells:
+            return True
+        saved[3] += 1
+        if saved[3] < saved[4]:
+            return False
+        limit = saved[4] * 2
+    history[codeptr] = [cellptr, cells[:], remaining, 0, limit]
+    return False
 
 
 def cleanup(code):
-    return list(filter(lambda x: x in ['.', ',', '[', ']', '<', '>', '+', '-'], code))
+    return list(filter(lambda x: x in COMMANDS, code))
 
 
 def buildbracemap(code):
@@ -2,105 +2,397 @@
 
 Python-compatible modified version of http://mazonka.com/brainf/stackbfi.c
 
+Code is parsed once into an array of instructions, with runs of + - < >
+folded together and jump targets resolved, which can then be run any number
+of times. evaluate() parses and runs in one go; compile() returns a Program
+that keeps the instructions for running against many inputs.
+
+The machine matches the original interpreter: cells are ints, the tape has
+TAPE_LENGTH cells and the program halts if the pointer leaves it, output is
+limited to OUTPUT_LENGTH bytes, an unmatched '[' that is skipped ends the
+program, and an unmatched ']' jumps back to the second character.
+
 */
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <string.h>
 #include <time.h>
 
+#define OUTPUT_LENGTH 4096
+#define TAPE_LENGTH 255
+#define CLOCK_INTERVAL 256 //back jumps between timeout checks
+
+enum { FINISHED, TIMED_OUT, DIVERGED, NO_MEMORY };
+
+typedef struct {
+	char op;
+	int count; //repeat count for + - < >, 1 otherwise
+	Py_ssize_t jump; //where [ and ] jump to
+	Py_ssize_t match; //index of the matching bracket, -1 if none
+	Py_ssize_t pos; //position in the source code, for profiling
+} instruction;
 
-struct cell{
-	struct cell *p, *n;
-	int v;
+/* machine state saved at a loop's back edge, for cycle detection */
+struct tracker{
+	Py_ssize_t ri;
+	int ptr, count, limit;
+	int tape[TAPE_LENGTH];
 };
-typedef struct cell cell;
 
-#define OUTPUT_LENGTH 4096
-#define MAX_DEPTH 255
-
-cell *ip, *mp;
-char* input_buffer;
-int ibl;
-int ri;
-int oi;
-char output_buffer[OUTPUT_LENGTH] = { '\0' };
-double timeout;
-int timed_out;
-clock_t start;
-int depth;
-
-void run(){
-	if(depth >= MAX_DEPTH) return;
-	while(ip && mp && ip->v){
-		int lev=1;
-		if( ip->v == '+' ) ++mp->v;
-		else if( ip->v == '-' ) --mp->v;
-		else if( ip->v == '.' && oi < OUTPUT_LENGTH) output_buffer[oi++] = mp->v;
-		else if( ip->v == ',' && ri < ibl) mp->v = input_buffer[ri++];
-		else if( ip->v == '<' ) mp = mp->p;
-		else if( ip->v == '>' ){
-			if( !mp->n ){
-				cell m; m.p=mp; 
-				m.n=0; m.v=0;
-				mp->n=&m; mp=&m;
-				ip=ip->n;
-				depth++;
-				run();
-				depth--;
-				return;
-			}
-			mp=mp->n;
+typedef struct {
+	const instruction *code;
+	Py_ssize_t length;
+	const char *input;
+	Py_ssize_t input_length, ri;
+	int tape[TAPE_LENGTH];
+	char output[OUTPUT_LENGTH];
+	int oi;
+	int status;
+	clock_t start;
+	double timeout;
+	struct tracker **trackers; //one per instruction, NULL unless detecting cycles
+
+	/* profiling counters */
+	unsigned long op_counts[128];
+	long *loop_counts; //iterations, indexed by the '[' instruction
+	int tape_extent;
+} machine;
+
+/*
+Brent's cycle detection at the back edge of the loop ending at pc: the saved
+state is replaced after 1, 2, 4, ... iterations, so a repeat of any period is
+found within a few periods. Every ']' gets its own tracker, allocated the
+first time it jumps back. Sets m->status and returns 1 if the run must stop.
+*/
+static int repeated(machine *m, Py_ssize_t pc, int ptr){
+	struct tracker *t = m->trackers[pc];
+	if( !t ){
+		t = m->trackers[pc] = PyMem_Malloc(sizeof(struct tracker));
+		if( !t ){
+			m->status = NO_MEMORY;
+			return 1;
 		}
-		else if( ip->v == '[' && !mp->v ){//skip if not zero
-			while(lev && ip->n){
-				ip=ip->n;
-				lev-=(ip->v==']')-(ip->v=='[');
-			}
+		t->limit = 1;
+	}
+	else{
+		if( t->ptr == ptr && t->ri == m->ri && !memcmp(t->tape, m->tape, sizeof(m->tape)) ){
+			m->status = DIVERGED;
+			return 1;
+		}
+		if( ++t->count < t->limit ) return 0;
+		t->limit *= 2;
+	}
+	t->ptr = ptr; t->ri = m->ri; t->count = 0;
+	memcpy(t->tape, m->tape, sizeof(m->tape));
+	return 0;
+}
+
+#define RUN run
+#define PROFILE(x)
+#include "brainfuck_run.h"
+#undef RUN
+#undef PROFILE
+
+#define RUN run_profiled
+#define PROFILE(x) x
+#include "brainfuck_run.h"
+#undef RUN
+#undef PROFILE
+
+/*
+Parse code into instructions, stopping at a '!' (which starts the input in
+evaluate), a NUL or a non-ASCII byte. *end is set to the position where
+parsing stopped. Returns NULL with an exception set on failure.
+*/
+static instruction* parse(const char *code, Py_ssize_t size, Py_ssize_t *length, Py_ssize_t *end){
+	instruction *program, *in;
+	Py_ssize_t *stack, top = 0, n = 0, i, restart;
+	char c;
+
+	for(i = 0; i < size && code[i] != '!' && code[i] > 0; i++);
+	*end = i;
+
+	program = PyMem_Malloc((i + 1) * sizeof(instruction));
+	stack = PyMem_Malloc((i + 1) * sizeof(Py_ssize_t));
+	if(!program || !stack){
+		PyMem_Free(program);
+		PyMem_Free(stack);
+		PyErr_NoMemory();
+		return NULL;
+	}
+
+	for(i = 0; i < *end; i++){
+		c = code[i];
+		if(!strchr("+-<>[].,", c)) continue;
+		//fold runs, except into the first instruction: an unmatched ']'
+		//jumps to the second character
+		if(strchr("+-<>", c) && n > 0 && program[n-1].op == c && program[n-1].pos != 0){
+			program[n-1].count++;
+			continue;
 		}
-		else if( ip->v == ']' && mp->v ){
-			if(clock() - start > timeout){//timeout can only occur with loops right?
-				timed_out = 1;
-				return;
-			}
-			while(lev && ip->p){
-				ip=ip->p;
-				lev+=(ip->v==']')-(ip->v=='[');
-			}
+		in = &program[n];
+		in->op = c;
+		in->count = 1;
+		in->match = -1;
+		in->pos = i;
+		if(c == '[') stack[top++] = n;
+		else if(c == ']' && top > 0){
+			in->match = stack[--top];
+			program[in->match].match = n;
 		}
-		ip=ip->n;
+		n++;
+	}
+	PyMem_Free(stack);
+
+	for(restart = 0; restart < n && program[restart].pos < 1; restart++);
+	for(i = 0; i < n; i++){
+		in = &program[i];
+		if(in->op == '[') in->jump = in->match >= 0 ? in->match + 1 : n;
+		else if(in->op == ']') in->jump = in->match >= 0 ? in->match + 1 : restart;
 	}
+	*length = n;
+	return program;
 }
 
-void readp(cell *p){
-	int cmd = input_buffer[ri++];
-	if( cmd == '!' || cmd<=0 || ri > ibl ){
-		cell m; m.p=m.n=0;
-		m.v=0; mp=&m;
-		start = clock();
-		run();
+/* build the stats dict returned when profiling */
+static PyObject* profile_stats(machine *m){
+	static const char commands[] = ".,[]<>+-";
+	char key[2] = { '\0', '\0' };
+	PyObject *opcodes, *loops, *pair, *value;
+	Py_ssize_t i;
+	unsigned long steps = 0;
+
+	opcodes = PyDict_New();
+	for(i = 0; opcodes && commands[i]; i++){
+		key[0] = commands[i];
+		steps += m->op_counts[(int)commands[i]];
+		value = PyLong_FromUnsignedLong(m->op_counts[(int)commands[i]]);
+		if(!value || PyDict_SetItemString(opcodes, key, value) < 0) Py_CLEAR(opcodes);
+		Py_XDECREF(value);
 	}
-	else{
-		cell c; c.p = p;
-		c.n=0; c.v=cmd;
-		if(p) p->n = &c;
-		else ip = &c;
-		readp(&c);
+	if(!opcodes) return NULL;
+
+	loops = PyDict_New();
+	for(i = 0; loops && i < m->length; i++){
+		if(m->code[i].op != '[' || m->code[i].match < 0 || !m->loop_counts[i]) continue;
+		pair = Py_BuildValue("(nn)", m->code[i].pos, m->code[m->code[i].match].pos);
+		value = PyLong_FromLong(m->loop_counts[i]);
+		if(!pair || !value || PyDict_SetItem(loops, pair, value) < 0) Py_CLEAR(loops);
+		Py_XDECREF(pair);
+		Py_XDECREF(value);
+	}
+	if(!loops){
+		Py_DECREF(opcodes);
+		return NULL;
+	}
+	return Py_BuildValue("{s:N,s:N,s:i,s:k}", "opcodes", opcodes, "loops", loops,
+	                     "tape_extent", m->tape_extent, "steps", steps);
+}
+
+/* run parsed code on an input, returning what evaluate returns */
+static PyObject* execute(const instruction *code, Py_ssize_t length,
+                         const char *input, Py_ssize_t input_length,
+                         double timeout, int detect_cycles, int profiling){
+	machine m;
+	PyObject *output, *stats;
+	Py_ssize_t i;
+
+	m.code = code;
+	m.length = length;
+	m.input = input;
+	m.input_length = input_length;
+	m.ri = 0;
+	memset(m.tape, 0, sizeof(m.tape));
+	m.oi = 0;
+	m.status = FINISHED;
+	m.timeout = timeout * CLOCKS_PER_SEC; //convert to clock ticks
+	m.trackers = NULL;
+	m.loop_counts = NULL;
+
+	if(detect_cycles){
+		m.trackers = PyMem_Calloc(length + 1, sizeof(struct tracker*));
+		if(!m.trackers) return PyErr_NoMemory();
+	}
+	if(profiling){
+		m.loop_counts = PyMem_Calloc(length + 1, sizeof(long));
+		if(!m.loop_counts){
+			PyMem_Free(m.trackers);
+			return PyErr_NoMemory();
+		}
+		memset(m.op_counts, 0, sizeof(m.op_counts));
+		m.tape_extent = 1;
+	}
+
+	m.start = clock();
+	if(profiling) run_profiled(&m);
+	else run(&m);
+	if(m.trackers){
+		for(i = 0; i < length; i++) PyMem_Free(m.trackers[i]);
+		PyMem_Free(m.trackers);
+	}
+
+	if(m.status == NO_MEMORY){
+		PyMem_Free(m.loop_counts);
+		return PyErr_NoMemory();
+	}
+	if(m.status == DIVERGED){
+		output = Py_None;
+		Py_INCREF(output);
+	}
+	else if(m.status == TIMED_OUT){
+		output = Py_BuildValue("s","");
+	}
+	else output = PyUnicode_DecodeLatin1(m.output, m.oi, NULL);
+	if(!profiling) return output;
+
+	stats = output ? profile_stats(&m) : NULL;
+	PyMem_Free(m.loop_counts);
+	if(!stats){
+		Py_XDECREF(output);
+		return NULL;
+	}
+	return Py_BuildValue("(NN)", output, stats);
+}
+
+static PyObject* evaluate(PyObject* self, PyObject *args, PyObject *kwargs){
+	static char *kwlist[] = {"code", "timeout", "detect_cycles", "profile", NULL};
+	const char *code;
+	Py_ssize_t size, length, end;
+	double timeout = 5;
+	int detect_cycles = 0, profiling = 0;
+	instruction *program;
+	PyObject *result;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|dpp", kwlist, &code, &size,
+	                                 &timeout, &detect_cycles, &profiling)) {
+	  return NULL;
+	}
+	program = parse(code, size, &length, &end);
+	if(!program) return NULL;
+	end = end < size ? end + 1 : size; //input starts after the '!'
+	result = execute(program, length, code + end, size - end, timeout, detect_cycles, profiling);
+	PyMem_Free(program);
+	return result;
+}
+
+
+/* Program: parsed code that can be run many times */
+
+typedef struct {
+	PyObject_HEAD
+	instruction *code;
+	Py_ssize_t length;
+} Program;
+
+static PyTypeObject ProgramType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"cbrainfuck.Program" //other fields are filled in by PyInit_cbrainfuck
+};
+
+static void Program_dealloc(Program *self){
+	PyMem_Free(self->code);
+	PyObject_Del(self);
+}
+
+static PyObject* Program_run(Program *self, PyObject *args, PyObject *kwargs){
+	static char *kwlist[] = {"input", "timeout", "detect_cycles", "profile", NULL};
+	Py_buffer input = { NULL, NULL };
+	double timeout = 5;
+	int detect_cycles = 0, profiling = 0;
+	PyObject *result;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|s*dpp", kwlist, &input,
+	                                 &timeout, &detect_cycles, &profiling)) {
+	  return NULL;
 	}
+	result = execute(self->code, self->length, input.buf, input.buf ? input.len : 0,
+	                 timeout, detect_cycles, profiling);
+	PyBuffer_Release(&input);
+	return result;
 }
 
-static PyObject* evaluate(PyObject* self, PyObject *args){
-	ibl = ri = oi = timed_out = 0;
-	if (!PyArg_ParseTuple(args, "s#|d", &input_buffer, &ibl, &timeout)) {
+static PyObject* Program_run_many(Program *self, PyObject *args, PyObject *kwargs){
+	static char *kwlist[] = {"inputs", "timeout", "detect_cycles", "profile", NULL};
+	PyObject *inputs, *iterator, *item, *results, *result;
+	Py_buffer input;
+	const char *text;
+	Py_ssize_t size;
+	double timeout = 5;
+	int detect_cycles = 0, profiling = 0;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|dpp", kwlist, &inputs,
+	                                 &timeout, &detect_cycles, &profiling)) {
 	  return NULL;
 	}
-	timeout = timeout * 1000; //convert to seconds
-	if(ibl > 0) readp(0); //ignore empty code
-	if(timed_out){
-		return Py_BuildValue("s","");
+	iterator = PyObject_GetIter(inputs);
+	if(!iterator) return NULL;
+	results = PyList_New(0);
+
+	while(results && (item = PyIter_Next(iterator))){
+		if(PyUnicode_Check(item)){
+			text = PyUnicode_AsUTF8AndSize(item, &size); //cached by the str, not copied
+			result = text ? execute(self->code, self->length, text, size,
+			                        timeout, detect_cycles, profiling) : NULL;
+		}
+		else if(PyObject_GetBuffer(item, &input, PyBUF_SIMPLE) == 0){
+			result = execute(self->code, self->length, input.buf, input.len,
+			                 timeout, detect_cycles, profiling);
+			PyBuffer_Release(&input);
+		}
+		else result = NULL;
+		Py_DECREF(item);
+
+		if(!result || PyList_Append(results, result) < 0) Py_CLEAR(results);
+		Py_XDECREF(result);
 	}
-	return PyUnicode_DecodeLatin1(output_buffer, oi, NULL);
+	Py_DECREF(iterator);
+	if(results && PyErr_Occurred()) Py_CLEAR(results);
+	return results;
+}
+
+static PyMethodDef Program_methods[] = {
+	{"run", (PyCFunction)Program_run, METH_VARARGS | METH_KEYWORDS,
+	 "run(input=b'', timeout=5, detect_cycles=False, profile=False)\n\n"
+	 "Run the program on input (a str or any bytes-like object, which is\n"
+	 "read in place) and return what evaluate would. timeout is the time\n"
+	 "budget in seconds."},
+	{"run_many", (PyCFunction)Program_run_many, METH_VARARGS | METH_KEYWORDS,
+	 "run_many(inputs, timeout=5, detect_cycles=False, profile=False)\n\n"
+	 "Run the program on each input in turn, with the full timeout for\n"
+	 "each, and return the list of results."},
+	{NULL, NULL}
+};
+
+static PyObject* compile(PyObject* self, PyObject *args){
+	const char *code;
+	Py_ssize_t size, end;
+	Program *program;
+
+	if (!PyArg_ParseTuple(args, "s#", &code, &size)) {
+	  return NULL;
+	}
+	program = PyObject_New(Program, &ProgramType);
+	if(!program) return NULL;
+	program->code = parse(code, size, &program->length, &end);
+	if(!program->code){
+		Py_DECREF(program);
+		return NULL;
+	}
+	return (PyObject*)program;
 }
 
 static PyMethodDef cbrainfuck_methods[] = {
-	{"evaluate", (PyCFunction)evaluate, METH_VARARGS, NULL},
+	{"evaluate", (PyCFunction)evaluate, METH_VARARGS | METH_KEYWORDS,
+	 "evaluate(code, timeout=5, detect_cycles=False, profile=False)\n\n"
+	 "Run brainfuck code (input follows a '!') and return its output.\n"
+	 "Returns '' on timeout, or None if detect_cycles is set and the\n"
+	 "program was found to be stuck in a loop.\n"
+	 "If profile is set, returns (output, stats) with stats in the same\n"
+	 "format as brainfuck.profile_evaluate."},
+	{"compile", (PyCFunction)compile, METH_VARARGS,
+	 "compile(code)\n\n"
+	 "Parse brainfuck code once and return a Program that can be run on\n"
+	 "many inputs. Parsing stops at a '!'; pass input to Program.run."},
 	{NULL, NULL}
 };
 
@@ -117,8 +409,20 @@ static struct PyModuleDef moduledef = {
 };
 
 PyObject* PyInit_cbrainfuck(void){
-	PyObject* module = PyModule_Create(&moduledef);
+	PyObject* module;
+
+	ProgramType.tp_basicsize = sizeof(Program);
+	ProgramType.tp_dealloc = (destructor)Program_dealloc;
+	ProgramType.tp_flags = Py_TPFLAGS_DEFAULT;
+	ProgramType.tp_doc = "Parsed brainfuck code, see compile()";
+	ProgramType.tp_methods = Program_methods;
+	if (PyType_Ready(&ProgramType) < 0)
+		return NULL;
+
+	module = PyModule_Create(&moduledef);
 	if (module == NULL)
 		return NULL;
+	Py_INCREF(&ProgramType);
+	PyModule_AddObject(module, "Program", (PyObject*)&ProgramType);
 	return module;
-}
\ No newline at end of file
+}
@@ -0,0 +1,67 @@
+/*
+
+Interpreter loop, included twice by brainfuck2.c: once as run() with
+PROFILE(x) expanding to nothing, and once as run_profiled() with PROFILE(x)
+expanding to x, so profiling costs nothing when it is off.
+
+*/
+
+static void RUN(machine *m){
+	const instruction *code = m->code, *in;
+	Py_ssize_t pc = 0, length = m->length;
+	int *tape = m->tape;
+	int ptr = 0;
+	int clock_countdown = 1;
+	while(pc < length){
+		in = &code[pc++];
+		PROFILE(m->op_counts[(int)in->op] += in->count;)
+		switch(in->op){
+		case '+':
+			tape[ptr] += in->count;
+			break;
+		case '-':
+			tape[ptr] -= in->count;
+			break;
+		case '>':
+			if(ptr + in->count >= TAPE_LENGTH){ //fell off the tape
+				PROFILE(m->op_counts['>'] -= in->count - (TAPE_LENGTH - ptr);)
+				return;
+			}
+			ptr += in->count;
+			PROFILE(if(ptr >= m->tape_extent) m->tape_extent = ptr + 1;)
+			break;
+		case '<':
+			if(ptr < in->count){ //fell off the tape
+				PROFILE(m->op_counts['<'] -= in->count - (ptr + 1);)
+				return;
+			}
+			ptr -= in->count;
+			break;
+		case '.':
+			if(m->oi < OUTPUT_LENGTH) m->output[m->oi++] = tape[ptr];
+			break;
+		case ',':
+			if(m->ri < m->input_length) tape[ptr] = m->input[m->ri++];
+			break;
+		case '[':
+			if(!tape[ptr]) pc = in->jump;
+			PROFILE(else m->loop_counts[pc - 1]++;)
+			break;
+		case ']':
+			if(tape[ptr]){
+				if(m->trackers && repeated(m, pc - 1, ptr)) return;
+				//timeout can only occur with loops
+				if(!--clock_countdown){
+					if(clock() - m->start > m->timeout){
+						m->status = TIMED_OUT;
+						return;
+					}
+					clock_countdown = CLOCK_INTERVAL;
+				}
+				pc = in->jump;
+				PROFILE(if(in->match >= 0) m->loop_counts[in->match]++;)
+			}
+			break;
+		}
+	}
+}
@@ -4,6 +4,7 @@ setup(
     ext_modules = [
         Extension("cbrainfuck",
                   sources=["brainfuck2.c"],
+                  depends=["brainfuck_run.h"],
                   ##extra_compile_args=['/Zi'],
                   ##extra_link_args=['/DEBUG']
         ),
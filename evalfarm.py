@@ -0,0 +1,400 @@
+"""
+evalfarm.py
+
+Distributed fitness evaluation over TCP.
+
+A Coordinator listens for worker processes and can be passed to
+GeneticAlgorithm as its eval_func. Each generation is split into small batches
+of gene strings which idle workers pull from the coordinator. Batches held by
+a worker that disconnects are resubmitted, and once the queue is empty idle
+workers also take a copy of batches still running elsewhere (work stealing),
+so one slow host cannot stall a generation. The first result back wins.
+
+Workers are stateless; all they need is to be able to import the fitness
+function (a normal GeneticAlgorithm eval_func, usually wrapping brainfuck or
+cbrainfuck). Start them on any host with
+
+    python evalfarm.py -c <host>:<port> [-n <processes>] [-i <module>]
+
+The coordinator listens on 127.0.0.1 by default. Remote workers need it to
+listen on a wider address (e.g. host="0.0.0.0"), but the protocol has no
+authentication: anything that can connect can join as a worker and return
+made-up fitness values, so only do that on a trusted network.
+
+The protocol is one JSON object per line:
+
+    coordinator -> worker: {"id": <batch>, "fitness": <name>, "genes": [...]}
+    worker -> coordinator: {"id": <batch>, "fitness": [...]}
+                           {"id": <batch>, "error": <message>}
+
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import getopt
+import importlib
+import itertools
+import threading
+import subprocess
+import collections
+import multiprocessing
+
+from genalg import Chromosome
+
+
+FITNESS_FUNCTIONS = {}
+
+
+def register_fitness(name, func=None):
+    """Register a fitness function under a name workers can look up
+
+    Can also be used as a decorator: @register_fitness("name")
+    """
+    if func is None:
+        return lambda f: register_fitness(name, f)
+    FITNESS_FUNCTIONS[name] = func
+    return func
+
+
+def resolve_fitness(name):
+    """Find a fitness function by registered name or by "module:function" """
+    if name in FITNESS_FUNCTIONS:
+        return FITNESS_FUNCTIONS[name]
+    module, _, attr = name.partition(":")
+    if not attr:
+        raise KeyError("unknown fitness function %r" % name)
+    return getattr(importlib.import_module(module), attr)
+
+
+def fitness_name(func):
+    """Return the "module:function" name workers use to import func
+
+    Functions defined in a script run as __main__ are named after the
+    script's file, so the script must be importable by the workers.
+    """
+    module = func.__module__
+    if module == "__main__":
+        main_file = getattr(sys.modules["__main__"], "__file__", None)
+        if main_file is None:
+            raise ValueError("cannot name a fitness function defined "
+                             "interactively; register it instead")
+        module = os.path.splitext(os.path.basename(main_file))[0]
+    return "%s:%s" % (module, func.__name__)
+
+
+def evaluate_genes(func, genes):
+    """Run an eval_func on a gene string and return the fitness"""
+    chromo = Chromosome(genes)
+    func(chromo)
+    return chromo.fitness
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + "\n").encode())
+
+
+class Coordinator():
+
+    """Hands out population batches to remote workers
+
+    Usable as the eval_func of a GeneticAlgorithm: it evaluates whole
+    populations through evaluate_population, or single chromosomes when
+    called directly.
+
+    """
+
+    def __init__(self, fitness, host="127.0.0.1", port=0, batch_size=4, steal=True,
+                 timeout=None):
+        """
+        fitness (string or function):
+            The fitness function workers should run, either a registered
+            name, "module:function", or the function itself.
+
+        host, port:
+            Address to listen on. Port 0 picks a free port; the actual
+            address is available as the address attribute. The default
+            host only accepts local workers; use "0.0.0.0" (or a specific
+            interface) for remote ones, on a trusted network only, since
+            workers are not authenticated.
+
+        batch_size (int):
+            Number of chromosomes sent to a worker at a time.
+
+        steal (bool):
+            If True, idle workers re-run batches that are still outstanding
+            on other workers once nothing else is queued.
+
+        timeout (float):
+            Default time limit in seconds for evaluate_population, None to
+            wait indefinitely.
+
+        """
+        self.fitness = fitness if isinstance(fitness, str) else fitness_name(fitness)
+        self.batch_size = batch_size
+        self.steal = steal
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._batches = {}  # unfinished batch id => chromosomes
+        self._running = collections.Counter()  # batch id => workers running it
+        self._pending = collections.deque()
+        self._ids = itertools.count()
+        self._error = None
+        self._closed = False
+        self.workers = 0
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(64)
+        self.address = self._server.getsockname()
+
+        accept_thread = threading.Thread(target=self._accept)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def __call__(self, chromo):
+        self.evaluate_population([chromo])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evaluate_population(self, population, timeout=None):
+        """Evaluate all chromosomes on the workers, blocking until done
+
+        Raises RuntimeError if a worker fails, or if the population is not
+        done within timeout seconds (defaults to the coordinator's timeout),
+        e.g. because no worker ever connected.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("coordinator is closed")
+            for i in range(0, len(population), self.batch_size):
+                batch = next(self._ids)
+                self._batches[batch] = population[i:i + self.batch_size]
+                self._pending.append(batch)
+            self._cond.notify_all()
+
+            while self._batches and self._error is None and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._error = "timed out after %gs with %d workers connected" % (
+                        timeout, self.workers)
+                    break
+                self._cond.wait(remaining)
+
+            if self._error is not None or self._closed:
+                error = self._error or "coordinator closed"
+                self._error = None
+                self._batches.clear()
+                self._pending.clear()
+                raise RuntimeError("remote evaluation failed: %s" % error)
+
+    def wait_for_workers(self, count=1, timeout=None):
+        """Block until at least count workers are connected
+
+        Returns False if the timeout ran out first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.workers < count:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        """Stop accepting work and disconnect all workers"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self._server.accept()
+            except OSError:
+                return  # server socket closed
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _next_batch(self):
+        """Wait for a batch to hand out; None once closed (lock held)"""
+        while not self._closed:
+            while self._pending:
+                batch = self._pending.popleft()
+                if batch in self._batches:
+                    return batch
+            if self.steal:
+                # only duplicate batches that no other idle worker has taken
+                for batch in self._batches:
+                    if self._running[batch] == 1:
+                        return batch
+            self._cond.wait()
+        return None
+
+    def _release(self, batch):
+        """Give up a batch held by a lost worker (lock held)"""
+        self._running[batch] -= 1
+        if self._running[batch] <= 0:
+            del self._running[batch]
+            if batch in self._batches:
+                self._pending.appendleft(batch)  # resubmit first
+
+    def _finish(self, batch, reply):
+        """Record a worker's reply to a batch (lock held)"""
+        self._running[batch] -= 1
+        if self._running[batch] <= 0:
+            del self._running[batch]
+        chromos = self._batches.pop(batch, None)
+        if chromos is None:
+            return  # already finished by another worker
+        fitnesses = reply.get("fitness")
+        if "error" in reply:
+            self._error = reply["error"]
+        elif not isinstance(fitnesses, list) or len(fitnesses) != len(chromos):
+            self._error = "worker returned %r for a batch of %d chromosomes" % (
+                fitnesses, len(chromos))
+        else:
+            for chromo, fitness in zip(chromos, fitnesses):
+                chromo.fitness = fitness
+        self._cond.notify_all()
+
+    def _serve(self, conn):
+        reader = conn.makefile("r")
+        batch = None
+        with self._cond:
+            self.workers += 1
+            self._cond.notify_all()
+        try:
+            while True:
+                with self._cond:
+                    batch = self._next_batch()
+                    if batch is None:
+                        return
+                    self._running[batch] += 1
+                    genes = [chromo.s for chromo in self._batches[batch]]
+                _send(conn, {"id": batch, "fitness": self.fitness, "genes": genes})
+                line = reader.readline()
+                if not line:
+                    return  # worker disconnected
+                reply = json.loads(line)
+                with self._cond:
+                    self._finish(batch, reply)
+                    batch = None
+        except (OSError, ValueError):
+            pass  # lost worker; its batch is resubmitted below
+        finally:
+            with self._cond:
+                self.workers -= 1
+                if batch is not None:
+                    self._release(batch)
+                self._cond.notify_all()
+            reader.close()
+            conn.close()
+
+
+def serve(host, port, connect_timeout=10):
+    """Run a worker: evaluate batches from the coordinator until it goes away"""
+    deadline = time.time() + connect_timeout
+    while True:
+        try:
+            conn = socket.create_connection((host, port))
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(.1)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    reader = conn.makefile("r")
+    functions = {}
+    try:
+        for line in reader:
+            request = json.loads(line)
+            try:
+                name = request["fitness"]
+                if name not in functions:
+                    functions[name] = resolve_fitness(name)
+                func = functions[name]
+                reply = {"id": request["id"],
+                         "fitness": [evaluate_genes(func, g) for g in request["genes"]]}
+            except Exception as e:
+                reply = {"id": request["id"], "error": repr(e)}
+            _send(conn, reply)
+    except OSError:
+        pass  # coordinator went away
+    finally:
+        reader.close()
+        conn.close()
+
+
+def spawn_workers(address, count=1, imports=()):
+    """Start count local worker processes for a coordinator address
+
+    The workers get this process's sys.path so they can import the same
+    fitness functions. Returns the list of subprocess.Popen objects;
+    closing the coordinator makes them exit.
+    """
+    host, port = address[:2]
+    if host in ("", "0.0.0.0"):
+        host = "127.0.0.1"
+    args = [sys.executable, os.path.abspath(__file__), "-c", "%s:%d" % (host, port)]
+    for module in imports:
+        args += ["-i", module]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(os.path.abspath(p) for p in sys.path)
+    return [subprocess.Popen(args, env=env) for i in range(count)]
+
+
+def main(argv):
+    usage = 'evalfarm.py -c <host>:<port> [-n <processes>] [-i <module>]'
+    host = port = None
+    processes = 1
+    try:
+        opts, args = getopt.getopt(argv, "hc:n:i:", ["connect=", "processes=", "import="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ("-c", "--connect"):
+            host, _, port = arg.rpartition(":")
+            port = int(port)
+        elif opt in ("-n", "--processes"):
+            processes = int(arg)
+        elif opt in ("-i", "--import"):
+            importlib.import_module(arg)  # modules that call register_fitness
+
+    if port is None:
+        print(usage)
+        sys.exit(2)
+
+    if processes == 1:
+        serve(host or "127.0.0.1", port)
+    else:
+        workers = [multiprocessing.Process(target=serve, args=(host or "127.0.0.1", port))
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -18,6 +18,44 @@ class Chromosome:
         self.fitness = 0
 
 
+def match_brackets(genes, brackets="[]"):
+    """Return a map between the positions of matching brackets
+
+    Unmatched brackets are left out.
+    """
+    opening, closing = brackets
+    stack, partners = [], {}
+    for position, gene in enumerate(genes):
+        if gene == opening:
+            stack.append(position)
+        elif gene == closing and stack:
+            start = stack.pop()
+            partners[start] = position
+            partners[position] = start
+    return partners
+
+
+def block_ends(genes, start, brackets="[]"):
+    """Return every end such that genes[start:end] is balanced
+
+    The stretch cannot leave the loop that start is in, so the list always
+    begins with start itself (the empty stretch).
+    """
+    opening, closing = brackets
+    ends = [start]
+    depth = 0
+    for position in range(start, len(genes)):
+        if genes[position] == opening:
+            depth += 1
+        elif genes[position] == closing:
+            depth -= 1
+            if depth < 0:
+                break
+        if depth == 0:
+            ends.append(position + 1)
+    return ends
+
+
 class GeneticAlgorithm():
 
     """A general-purpose genetic algorithm class
@@ -32,7 +70,11 @@ class GeneticAlgorithm():
                  positive_fitness=True,
                  selection_function="tournament_8",
                  crossover_function="uniform",
-                 chromosome_size=-1):
+                 chromosome_size=-1,
+                 prescreen_func=None,
+                 mutation_function="standard",
+                 random_seed=None,
+                 surrogate=None):
         """
         genetic_alphabet (list<string>):
             This is a list of all chars in the genetic alphabet used to define
@@ -42,6 +84,8 @@ class GeneticAlgorithm():
             This is the function to use for chromosome evaluation.Note: this
             function should take one argument (the chromosome object) and set
             its fitness score. Does not return anything.
+            An object with an evaluate_population(population) method
+            (e.g. evalfarm.Coordinator) will be given whole populations.
 
         use_elitism (bool):
             Flag to determine whether or not the best chromosome for each
@@ -72,6 +116,11 @@ class GeneticAlgorithm():
                                on partitions, in order. Delimiter must
                                be part of the genetic alphabet. Use
                                delimited_x to specify x as delimiter.
+                'subtree' => swaps a random balanced stretch of genes
+                             (e.g. a whole loop or loop body) between
+                             the chromosomes, so no brackets are left
+                             unmatched. Brackets default to '[' and
+                             ']'; use subtree_xy for x and y instead.
 
         chromosome_size (int):
             If set to None, chromosomes can change in size
@@ -83,14 +132,49 @@ class GeneticAlgorithm():
             If specified, data will be written to this file
             for each generation.
 
+        prescreen_func (function):
+            If set, this is called on each chromosome before evaluation
+            and should return True if the chromosome still needs to be
+            evaluated. It may instead set the fitness itself (e.g. a
+            penalty from bfanalysis.Prescreener) and return False.
+
+        mutation_function (string):
+            Determines which mutation function to use.
+            Currently supported:
+                'standard' => insertion, deletion and substitution of
+                              single genes
+                'balanced' => same, but brackets are only inserted and
+                              deleted in matched pairs. Use balanced_xy
+                              to use x and y as brackets.
+
+            Note: if 'subtree' crossover or 'balanced' mutation is used,
+            unmatched brackets in the initial population are replaced.
+            Use both to keep every chromosome balanced.
+
+        random_seed:
+            If set, seeds this instance's random number generator so that
+            runs are reproducible, even when several run concurrently.
+            Otherwise the random module itself is used, so random.seed()
+            still makes runs reproducible.
+
+        surrogate (object):
+            If set (e.g. surrogate.Surrogate), it picks which chromosomes
+            of each generation are worth evaluating, using a model trained
+            on earlier evaluations; the rest get a fitness from it without
+            being evaluated.
+
         """
         self.genetic_alphabet = genetic_alphabet
+        self.random = random if random_seed is None else random.Random(random_seed)
         self.crossover_rate = .9
         self.mutation_rate = .05
         self.evaluate = eval_func
         self.use_elitism = use_elitism
         self.positive_fitness = positive_fitness
         self.chromosome_size = chromosome_size
+        self.prescreen = prescreen_func
+        self.surrogate = surrogate
+        self.brackets = None
 
         if selection_function == 'roulette':
             self.selection_function = self.roulette_selection
@@ -108,6 +192,11 @@ class GeneticAlgorithm():
 
         if crossover_function == 'one_point':
             self.crossover_function = self.one_point_crossover
+        elif 'subtree' in crossover_function:
+            tmp = crossover_function.split("_")
+            self.brackets = tmp[-1] if len(tmp) == 2 else "[]"
+            brackets = self.brackets
+            self.crossover_function = lambda ch1,ch2: self.subtree_crossover(ch1,ch2,brackets)
         elif 'uniform' in crossover_function:
             tmp = crossover_function.split("_")
             if len(tmp) == 2:
@@ -128,6 +217,14 @@ class GeneticAlgorithm():
             else:
                 self.crossover_function = self.delimited_crossover_v2
 
+        if 'balanced' in mutation_function:
+            tmp = mutation_function.split("_")
+            self.brackets = tmp[-1] if len(tmp) == 2 else "[]"
+            mutation_brackets = self.brackets
+            self.mutation_function = lambda chromo: self.balanced_mutate(chromo,mutation_brackets)
+        else:
+            self.mutation_function = self.mutate
+
     def mutate(self, chromo):
         """mutate a chromosome and return a new, mutated one
 
@@ -139,28 +236,88 @@ class GeneticAlgorithm():
 
         def choose_mutation():
             def insertion(x):
-                return random.choice(self.genetic_alphabet) + x
+                return self.random.choice(self.genetic_alphabet) + x
 
             def deletion(x):
                 return ""
 
             def substitution(x):
-                return random.choice(self.genetic_alphabet)
+                return self.random.choice(self.genetic_alphabet)
 
             if self.chromosome_size == -1:
-                return random.choice((insertion,deletion,substitution))
+                return self.random.choice((insertion,deletion,substitution))
             else:
                 return substitution
 
         ch = "" # create new genes for chromo
         for gene in chromo.s:
-            if random.random() < self.mutation_rate: # do mutation
+            if self.random.random() < self.mutation_rate: # do mutation
                 ch += choose_mutation()(gene)
             else:
                 ch += gene
 
         return Chromosome(ch)
 
+    def balanced_mutate(self, chromo, brackets="[]"):
+        """mutate a chromosome without leaving brackets unmatched
+
+        Same mutations as mutate, except:
+            - an inserted bracket becomes a pair wrapping a random
+              balanced stretch of the following genes in a loop
+            - deleting a bracket also deletes its partner
+            - brackets are never substituted, and other genes are only
+              substituted with non-bracket genes
+        """
+        opening, closing = brackets
+        genes = chromo.s
+        partners = match_brackets(genes, brackets)
+        plain = [g for g in self.genetic_alphabet if g not in brackets]
+
+        inserted = [[] for i in range(len(genes) + 1)] # genes to insert before each position
+        deleted = set()
+        substituted = {}
+        for i, gene in enumerate(genes):
+            if self.random.random() >= self.mutation_rate:
+                continue
+            if self.chromosome_size == -1:
+                mutation = self.random.choice(("insertion", "deletion", "substitution"))
+            else:
+                mutation = "substitution"
+
+            if mutation == "insertion":
+                new = self.random.choice(self.genetic_alphabet)
+                if new in brackets:
+                    ends = block_ends(genes, i, brackets)[1:]
+                    if ends:
+                        inserted[i].append(opening)
+                        inserted[self.random.choice(ends)].append(closing)
+                        continue
+                    if not plain:
+                        continue
+                    new = self.random.choice(plain)
+                inserted[i].append(new)
+            elif mutation == "deletion":
+                deleted.add(i)
+                deleted.add(partners.get(i, i))
+            elif gene not in brackets and plain:
+                substituted[i] = self.random.choice(plain)
+
+        ch = []
+        for i, gene in enumerate(genes):
+            ch.extend(inserted[i])
+            if i not in deleted:
+                ch.append(substituted.get(i, gene))
+        ch.extend(inserted[-1])
+
+        return Chromosome("".join(ch))
+
+    def balance(self, genes, brackets="[]"):
+        """Replace unmatched brackets with random non-bracket genes"""
+        partners = match_brackets(genes, brackets)
+        plain = [g for g in self.genetic_alphabet if g not in brackets]
+        return "".join(self.random.choice(plain) if gene in brackets and i not in partners else gene
+                       for i, gene in enumerate(genes))
+
     def one_point_crossover(self, ch1, ch2):
         """Perform one point crossover between two chromosomes
 
@@ -171,7 +328,7 @@ class GeneticAlgorithm():
 
         ch1 = ch1.s
         ch2 = ch2.s
-        r = random.random()
+        r = self.random.random()
         r1 = int(len(ch1) * r)
         r2 = int(len(ch2) * r)
         return Chromosome(ch1[:r1] + ch2[r2:]), Chromosome(ch2[:r2] + ch1[r1:])
@@ -187,7 +344,7 @@ class GeneticAlgorithm():
 
         len1 = len(ch1)
         len2 = len(ch2)
-        crosspoints = sorted([random.random() for x in range(int(min(len1,len2)*mixing_ratio))])
+        crosspoints = sorted([self.random.random() for x in range(int(min(len1,len2)*mixing_ratio))])
         prev1 = prev2 = i = 0
         out1 = ""
         out2 = ""
@@ -211,6 +368,26 @@ class GeneticAlgorithm():
 
         return Chromosome(out1), Chromosome(out2)
 
+    def subtree_crossover(self, ch1, ch2, brackets="[]"):
+        """Swap a random balanced stretch of genes between the chromosomes
+
+        Each stretch starts at a random point and ends at a random point at
+        the same bracket depth, without leaving its enclosing loop, so it
+        can be a run of plain genes, whole loops, or a loop body. Swapping
+        such stretches never unbalances the brackets.
+
+        """
+        ch1 = ch1.s
+        ch2 = ch2.s
+
+        start1 = self.random.randint(0, len(ch1))
+        end1 = self.random.choice(block_ends(ch1, start1, brackets))
+        start2 = self.random.randint(0, len(ch2))
+        end2 = self.random.choice(block_ends(ch2, start2, brackets))
+
+        return (Chromosome(ch1[:start1] + ch2[start2:end2] + ch1[end1:]),
+                Chromosome(ch2[:start2] + ch1[start1:end1] + ch2[end2:]))
+
     def delimited_crossover(self, ch1, ch2, delimiter="#"):
         """Partition the chromosomes and swap their partitions based on delimiter
 
@@ -253,7 +430,7 @@ class GeneticAlgorithm():
 
         return Chromosome(o1),Chromosome(o2)
 
-    def delimited_crossover_v2(ch1, ch2, delimiter="#"):
+    def delimited_crossover_v2(self, ch1, ch2, delimiter="#"):
         """Partition the chromosomes and swap their partitions based on delimiter
 
         Uses ratio-based delimiters from one chromosome chosen at random to swap with the other
@@ -266,7 +443,7 @@ class GeneticAlgorithm():
 
         o1 = ""
         o2 = ""
-        if random.getrandbits(1):
+        if self.random.getrandbits(1):
             crosspoints = [pos/len1 for pos, char in enumerate(ch1) if char == delimiter]   
         else:
             crosspoints = [pos/len2 for pos, char in enumerate(ch2) if char == delimiter]
@@ -299,7 +476,7 @@ class GeneticAlgorithm():
         fitnesses because their probability would be negative or null.
         """
         maxval = sum([c.fitness for c in population])
-        pick = random.uniform(0, maxval)
+        pick = self.random.uniform(0, maxval)
         current = 0
         for chromosome in population:
             current += chromosome.fitness
@@ -314,9 +491,9 @@ class GeneticAlgorithm():
         This works for both maximizing and minimizing fitnesses.
 
         """
-        best = random.choice(population)
+        best = self.random.choice(population)
         for i in range(k):
-            chromo = random.choice(population)
+            chromo = self.random.choice(population)
             if self.positive_fitness and chromo.fitness > best.fitness:
                 best = chromo
             elif not self.positive_fitness and chromo.fitness < best.fitness:
@@ -326,14 +503,14 @@ class GeneticAlgorithm():
     def breed(self, ch1, ch2):
         """Perform crossover and mutation based on two chromosomes"""
         # rate dependent crossover of selected chromosomes
-        if random.random() < self.crossover_rate:
+        if self.random.random() < self.crossover_rate:
             newCh1, newCh2 = self.crossover_function(ch1, ch2)
         else:
             newCh1, newCh2 = ch1, ch2
 
         # mutate crossovered chromos
-        newnewCh1 = self.mutate(newCh1)
-        newnewCh2 = self.mutate(newCh2)
+        newnewCh1 = self.mutation_function(newCh1)
+        newnewCh2 = self.mutation_function(newCh2)
 
         return newnewCh1, newnewCh2
 
@@ -344,6 +521,31 @@ class GeneticAlgorithm():
         """
         chromo.fitness = 0
 
+    def evaluate_population(self, population):
+        """assign fitness values to every chromosome in the population
+
+        If eval_func has an evaluate_population method of its own (such as
+        evalfarm.Coordinator), the whole population is handed to it at once
+        so it can be evaluated in batches. Chromosomes whose fitness is
+        settled by prescreen_func, or that the surrogate chooses to skip,
+        are not evaluated.
+        """
+        if self.prescreen is not None:
+            population = [chromo for chromo in population if self.prescreen(chromo)]
+
+        if self.surrogate is not None:
+            population, skipped = self.surrogate.select(population, self.positive_fitness)
+
+        evaluate_batch = getattr(self.evaluate, "evaluate_population", None)
+        if evaluate_batch is not None:
+            evaluate_batch(population)
+        else:
+            for chromosome in population:
+                self.evaluate(chromosome)
+
+        if self.surrogate is not None:
+            self.surrogate.observe(population, skipped)
+
     def generate_population(self, popSize):
         """generate and return the initial population"""
         chromos = []
@@ -351,19 +553,23 @@ class GeneticAlgorithm():
             chromo = Chromosome()
             if self.chromosome_size == None:
                 # arbitrary range of starting chromosome size
-                numgenes = random.randint(5, 50)
+                numgenes = self.random.randint(5, 50)
             else:
                 numgenes = self.chromosome_size
             for bit in range(numgenes):
-                chromo.s += random.choice(self.genetic_alphabet)
+                chromo.s += self.random.choice(self.genetic_alphabet)
+            if self.brackets is not None:
+                chromo.s = self.balance(chromo.s, self.brackets)
             chromos.append(chromo)
         return chromos
 
     def generate_seeded_population(self, popSize, seed):
         """generate and return the initial population based on a seed gene"""
+        if self.brackets is not None:
+            seed = self.balance(seed, self.brackets)
         chromos = [Chromosome(seed)]  # set first one as non-mutated
         for eachChromo in range(popSize - 1):
-            chromos.append(self.mutate(Chromosome(seed)))
+            chromos.append(self.mutation_function(Chromosome(seed)))
         return chromos
 
     def run(self, max_iterations=1000,
@@ -371,7 +577,8 @@ class GeneticAlgorithm():
                   seed=None,
                   fitness_threshold=None,
                   max_fitness=None,
-                  logfile=None):
+                  logfile=None,
+                  verbose=True):
         """Run the genetic algorithm
 
         parameters:
@@ -392,11 +599,16 @@ class GeneticAlgorithm():
         logfile(string):
             If specified, data will be written to this file
             for each generation.
+        verbose(bool):
+            if False, progress is not printed for each generation
 
         return:
 
             This function returns the highest fitness chromosome of the
-            final generation.
+            final generation. The chromosome itself, the number of
+            generations and the total runtime are also kept in the best,
+            generations and runtime attributes. If an exception stopped
+            the run, it is kept in the error attribute (None otherwise).
         """
 
         logging = True if logfile != None else False
@@ -456,6 +668,7 @@ class GeneticAlgorithm():
         else:
             pop = self.generate_population(population_size)
 
+        self.error = None
         try:
             best = Chromosome()
             prevbest = None
@@ -466,8 +679,7 @@ class GeneticAlgorithm():
             for i in itertools.count():
                 i_start = time.time()
                 # assign fitness values to all chromosomes
-                for chromosome in pop:
-                    self.evaluate(chromosome)
+                self.evaluate_population(pop)
                 avgf = sum([chromo.fitness for chromo in pop]) / len(pop)
                 # sort population by fitness
                 pop = sorted(pop, key=lambda x: x.fitness,
@@ -491,11 +703,14 @@ class GeneticAlgorithm():
                         break
 
                 logstr = "Generation %d:\n\tTime: %.5fs\n\tMax fitness: %.5f\n\tAverage Fitness: %.5f"%(i + 1, time.time()-i_start, best.fitness, avgf)
-                print(logstr)
-                print("improvement: %.5f"%improvement)
                 avgimp = sum(avgimplist)/windowsize
-                print("avg improvement: %.5f"%(avgimp))
-                print("mutation rate: %.5f"%self.mutation_rate)
+                if verbose:
+                    print(logstr)
+                    print("improvement: %.5f"%improvement)
+                    print("avg improvement: %.5f"%(avgimp))
+                    print("mutation rate: %.5f"%self.mutation_rate)
+                    if self.surrogate is not None:
+                        print(self.surrogate.status())
                 if avgimp == 0 and self.mutation_rate < .05:
                     self.mutation_rate += 0.001
                 else:
@@ -511,13 +726,18 @@ class GeneticAlgorithm():
                 if max_iterations != None and i > max_iterations:
                     break
         except Exception as e:
+            self.error = e
             print("Exception occurred: %r"%e)
         except KeyboardInterrupt:
             print("Interrupted: halting execution")
         finally:
             # sort final population by fitness
-            logstr = "Generation %d:\n\tTotal Runtime: %.5fs\n\tBest result:\n\tchromosome: %s\n\tfitness: %.5f"%(i + 1, time.time() - start_time, repr(best.s), best.fitness)
-            print(logstr)
+            self.best = best
+            self.generations = i + 1
+            self.runtime = time.time() - start_time
+            logstr = "Generation %d:\n\tTotal Runtime: %.5fs\n\tBest result:\n\tchromosome: %s\n\tfitness: %.5f"%(self.generations, self.runtime, repr(best.s), best.fitness)
+            if verbose:
+                print(logstr)
             if logging:
                 outfile.write(logstr)
 
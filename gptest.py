@@ -6,25 +6,35 @@ A test of genetic programming with python and brainfuck.
 """
 import cbrainfuck
 from genalg import GeneticAlgorithm
+from bfanalysis import Prescreener
+
+EMPTY = 0x454d505459
+ERROR = 0x4552524f52
+
+def score(result):
+    #score the output of a program
+    target_string='marmelade'
+    if len(result) != 0:
+        f = 0
+        for i in range(max(len(target_string),len(result))):
+            try:
+                f += abs(ord(result[i]) - ord(target_string[i]))
+            except IndexError:
+                f += 1000
+        return f
+    else:
+        return EMPTY
 
 def evaluate(chromo):
     #try to evaluate the code
-    target_string='marmelade'
     try:
-        result = cbrainfuck.evaluate(chromo.s,.005)
-        if len(result) != 0:
-            f = 0
-            for i in range(max(len(target_string),len(result))):
-                try:
-                    f += abs(ord(result[i]) - ord(target_string[i]))
-                except IndexError:
-                    f += 1000
-            chromo.fitness = f
-        else:
-            chromo.fitness = 0x454d505459
+        result = cbrainfuck.evaluate(chromo.s,.005,detect_cycles=True)
+        if result is None: #stuck in a loop, same as timing out
+            result = ""
+        chromo.fitness = score(result)
     except Exception as e:
         print(e)
-        chromo.fitness = 0x4552524f52
+        chromo.fitness = ERROR
 
 def main():
     genetic_code = ['>','<','+','-','.',',','[',']','#']
@@ -35,7 +45,10 @@ def main():
                           selection_function='tournament_16',
                           crossover_function='delimited',
                           #crossover_function='uniform',
-                          chromosome_size=-1)
+                          #crossover_function='subtree',
+                          #mutation_function='balanced',
+                          chromosome_size=-1,
+                          prescreen_func=Prescreener(ERROR, EMPTY, score))
     GA.run(None,100,max_fitness=0)
 if __name__ == "__main__":
     main()
@@ -0,0 +1,244 @@
+"""
+surrogate.py
+
+Online surrogate model that decides which offspring are worth a full
+fitness evaluation.
+
+The model is a linear regressor over gene n-gram counts, trained online
+(normalized least mean squares) on every real evaluation. It predicts how a
+chromosome's fitness ranks among recently evaluated ones rather than the
+fitness itself, so huge penalty values do not swamp it. Each generation only
+the most promising fraction of new chromosomes, plus a random exploration
+quota, is really evaluated; the rest are given the worst fitness actually
+seen in that generation.
+
+The rank correlation between predictions and real fitness is tracked, and
+the surrogate stays out of the way (everything is evaluated) until it has
+seen enough samples and while that correlation is too low.
+
+"""
+
+import bisect
+import random
+import collections
+
+
+def _ranks(values):
+    """Ranks of values (1 = smallest), ties get their average rank"""
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2. + 1
+        i = j + 1
+    return ranks
+
+
+def rank_correlation(xs, ys):
+    """Spearman rank correlation, None if either side is constant"""
+    rx, ry = _ranks(xs), _ranks(ys)
+    n = len(rx)
+    mx, my = sum(rx) / n, sum(ry) / n
+    cov = sum((a - mx) * (b - my) for a, b in zip(rx, ry))
+    vx = sum((a - mx) ** 2 for a in rx)
+    vy = sum((b - my) ** 2 for b in ry)
+    if vx == 0 or vy == 0:
+        return None
+    return cov / (vx * vy) ** .5
+
+
+class Surrogate():
+
+    """Fitness surrogate for GeneticAlgorithm
+
+    Pass an instance as the surrogate argument of a GeneticAlgorithm.
+    Chromosomes whose genes were evaluated recently are given their known
+    fitness without being evaluated again.
+
+    """
+
+    def __init__(self, ngram=3,
+                 fraction=.3,
+                 exploration=.1,
+                 warmup=200,
+                 window=2000,
+                 min_correlation=.3,
+                 learning_rate=.2,
+                 random_seed=None):
+        """
+        ngram (int):
+            features are counts of all gene substrings up to this length
+
+        fraction (float):
+            fraction of new chromosomes, best predicted first, that are
+            evaluated
+
+        exploration (float):
+            fraction of new chromosomes picked at random from the rest that
+            are evaluated as well, to keep training data unbiased
+
+        warmup (int):
+            number of real evaluations before the surrogate is used
+
+        window (int):
+            number of recent (genes, fitness) pairs remembered, both for
+            reusing known fitnesses and for ranking new ones
+
+        min_correlation (float):
+            the surrogate is only used while the running rank correlation
+            between its predictions and real fitness is at least this
+
+        learning_rate (float):
+            step size of the online regressor (0 < x < 2)
+
+        random_seed:
+            if set, seeds the exploration sampling; otherwise the random
+            module itself is used, like GeneticAlgorithm
+
+        """
+        self.ngram = ngram
+        self.fraction = fraction
+        self.exploration = exploration
+        self.warmup = warmup
+        self.window = window
+        self.min_correlation = min_correlation
+        self.learning_rate = learning_rate
+        self.random = random if random_seed is None else random.Random(random_seed)
+
+        self.positive_fitness = True
+        self.weights = {}
+        self.bias = .5
+        self.history = collections.OrderedDict()  # genes => fitness, oldest first
+        self.ordered = []  # fitnesses in history, sorted
+        self.samples = 0
+        self.correlation = None
+        self.enabled = False
+        self.evaluated = 0
+        self.skipped = 0
+        self._predictions = {}
+        self._explored = None  # ids of the random exploration sample, None while off
+
+    def features(self, genes):
+        """Return the n-gram counts of a gene string"""
+        counts = {}
+        for n in range(1, self.ngram + 1):
+            for i in range(len(genes) - n + 1):
+                gram = genes[i:i + n]
+                counts[gram] = counts.get(gram, 0) + 1
+        return counts
+
+    def predict(self, genes):
+        """Predict how genes' fitness compares to recent fitnesses
+
+        Returns the estimated fraction of recent fitnesses it beats, roughly
+        0 (worst) to 1 (best); higher is always better, whatever
+        positive_fitness is.
+        """
+        weights = self.weights
+        return self.bias + sum(weights.get(f, 0) * x for f, x in self.features(genes).items())
+
+    def select(self, population, positive_fitness=True):
+        """Split population into chromosomes to evaluate and to skip
+
+        Chromosomes with a remembered fitness are given it and left out of
+        both lists.
+        """
+        self.positive_fitness = positive_fitness
+        new = []
+        for chromo in population:
+            if chromo.s in self.history:
+                chromo.fitness = self.history[chromo.s]
+                self.history.move_to_end(chromo.s)
+            else:
+                new.append(chromo)
+
+        self._predictions = dict((id(chromo), self.predict(chromo.s)) for chromo in new)
+        self._explored = None
+        if not self.enabled or not new:
+            return new, []
+
+        ranked = sorted(new, key=lambda chromo: self._predictions[id(chromo)], reverse=True)
+        promising = max(1, int(round(len(new) * self.fraction)))
+        rest = ranked[promising:]
+        explore = self.random.sample(rest, min(len(rest), int(round(len(new) * self.exploration))))
+        self._explored = set(id(chromo) for chromo in explore)
+        skipped = [chromo for chromo in rest if id(chromo) not in self._explored]
+        return ranked[:promising] + explore, skipped
+
+    def observe(self, evaluated, skipped):
+        """Learn from the evaluated chromosomes and settle the skipped ones"""
+        self.evaluated += len(evaluated)
+        self.skipped += len(skipped)
+        if evaluated:
+            for chromo in evaluated:
+                self._remember(chromo.s, chromo.fitness)
+
+            targets = [self._score(chromo.fitness) for chromo in evaluated]
+
+            # while on, most evaluated chromosomes were picked for their high
+            # predictions, so accuracy is only measured on the random sample
+            if self._explored is None:
+                sample = list(zip(evaluated, targets))
+            else:
+                sample = [(chromo, target) for chromo, target in zip(evaluated, targets)
+                          if id(chromo) in self._explored]
+            if len(sample) >= 5:
+                predictions = [self._predictions.get(id(chromo), self.bias) for chromo, target in sample]
+                correlation = rank_correlation(predictions, [target for chromo, target in sample])
+                if correlation is not None:
+                    if self.correlation is None:
+                        self.correlation = correlation
+                    else:
+                        self.correlation = .8 * self.correlation + .2 * correlation
+
+            for chromo, target in zip(evaluated, targets):
+                self._train(chromo.s, target)
+
+        self.enabled = (self.samples >= self.warmup and self.correlation is not None
+                        and self.correlation >= self.min_correlation)
+
+        if skipped:
+            if evaluated:
+                fitnesses = [chromo.fitness for chromo in evaluated]
+            else:
+                fitnesses = self.ordered
+            worst = min(fitnesses) if self.positive_fitness else max(fitnesses)
+            for chromo in skipped:
+                chromo.fitness = worst
+
+    def status(self):
+        """Return a one line summary"""
+        return "surrogate %s: correlation %s, %d evaluated, %d skipped" % (
+            "on" if self.enabled else "off",
+            "n/a" if self.correlation is None else "%.3f" % self.correlation,
+            self.evaluated, self.skipped)
+
+    def _remember(self, genes, fitness):
+        if genes in self.history:
+            return
+        self.history[genes] = fitness
+        bisect.insort(self.ordered, fitness)
+        self.samples += 1
+        if len(self.history) > self.window:
+            genes, fitness = self.history.popitem(last=False)
+            del self.ordered[bisect.bisect_left(self.ordered, fitness)]
+
+    def _score(self, fitness):
+        """Fraction of remembered fitnesses that fitness beats (ties count half)"""
+        below = bisect.bisect_left(self.ordered, fitness)
+        above = len(self.ordered) - bisect.bisect_right(self.ordered, fitness)
+        ties = len(self.ordered) - below - above
+        score = (below + ties / 2.) / len(self.ordered)
+        return score if self.positive_fitness else 1 - score
+
+    def _train(self, genes, target):
+        features = self.features(genes)
+        error = target - self.predict(genes)
+        step = self.learning_rate * error / (1 + sum(x * x for x in features.values()))
+        self.bias += step
+        for f, x in features.items():
+            self.weights[f] = self.weights.get(f, 0) + step * x
@@ -0,0 +1,233 @@
+"""
+sweep.py
+
+Hyperparameter sweeps for GeneticAlgorithm.
+
+Every (configuration, random seed) run of a sweep is started at once, each
+in its own thread. The runs do little work themselves: their fitness
+evaluations all go to one shared process pool, through a fitness cache that
+is shared by every run, so the pool stays busy for the whole sweep instead
+of one configuration at a time.
+
+    configurations = sweep.grid(crossover_function=["uniform", "subtree"],
+                                mutation_rate=[.01, .05])
+    s = sweep.Sweep(genetic_code, gptest.evaluate,
+                    positive_fitness=False, max_fitness=0, max_iterations=500)
+    print(sweep.report(s.run(configurations, seeds=range(5))))
+
+The eval_func is sent to the pool's processes, so it must be importable
+(defined at module level). Since results are cached by genes, it should
+also be deterministic.
+
+"""
+
+import random
+import functools
+import itertools
+import threading
+import statistics
+import collections
+import concurrent.futures
+
+from genalg import GeneticAlgorithm, Chromosome
+
+
+# parameters passed to GeneticAlgorithm.run, and attributes set on the
+# GeneticAlgorithm; everything else goes to its constructor
+RUN_PARAMETERS = ("max_iterations", "population_size", "seed",
+                  "fitness_threshold", "max_fitness")
+ATTRIBUTES = ("mutation_rate", "crossover_rate")
+
+
+Run = collections.namedtuple("Run", ["seed", "reached", "runtime", "generations",
+                                     "evaluations", "fitness", "genes", "error"])
+
+
+def grid(**space):
+    """Return every combination of the given parameter values
+
+    grid(crossover_function=['uniform', 'subtree'], population_size=[50, 100])
+    """
+    names = sorted(space)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_search(count, random_seed=None, **space):
+    """Return count configurations sampled from the given values
+
+    Each value is either a list to choose from or a function that takes a
+    random.Random and returns a value, e.g. lambda r: r.uniform(.01, .1).
+    Without a random_seed the random module itself is used.
+    """
+    rng = random if random_seed is None else random.Random(random_seed)
+    names = sorted(space)
+    return [dict((name, space[name](rng) if callable(space[name]) else rng.choice(space[name]))
+                 for name in names)
+            for i in range(count)]
+
+
+def _fitness(eval_func, genes):
+    chromo = Chromosome(genes)
+    eval_func(chromo)
+    return chromo.fitness
+
+
+class SharedEvaluator():
+
+    """eval_func that evaluates on a shared pool through a shared cache
+
+    One is made per run so evaluations can be counted per run; the pool,
+    cache and lock are shared by all of them.
+
+    """
+
+    def __init__(self, eval_func, pool, cache, lock, chunksize=4):
+        self.eval_func = eval_func
+        self.pool = pool
+        self.cache = cache
+        self.lock = lock
+        self.chunksize = chunksize
+        self.evaluations = 0
+
+    def __call__(self, chromo):
+        self.evaluate_population([chromo])
+
+    def evaluate_population(self, population):
+        self.evaluations += len(population)
+        with self.lock:
+            missing = list(set(chromo.s for chromo in population
+                               if chromo.s not in self.cache))
+        if missing:
+            results = self.pool.map(functools.partial(_fitness, self.eval_func),
+                                    missing, chunksize=self.chunksize)
+            results = dict(zip(missing, results))
+            with self.lock:
+                self.cache.update(results)
+        else:
+            results = {}
+        with self.lock:
+            for chromo in population:
+                chromo.fitness = results.get(chromo.s, self.cache.get(chromo.s))
+
+
+class Sweep():
+
+    """Runs many GeneticAlgorithm configurations at once
+
+    Configurations are dicts of GeneticAlgorithm constructor arguments,
+    run() arguments (see RUN_PARAMETERS) and attributes (see ATTRIBUTES).
+
+    """
+
+    def __init__(self, genetic_alphabet, eval_func, processes=None,
+                 concurrency=None, **defaults):
+        """
+        genetic_alphabet, eval_func:
+            as for GeneticAlgorithm
+
+        processes (int):
+            size of the shared process pool, defaults to the CPU count
+
+        concurrency (int):
+            maximum number of runs in progress at a time, defaults to all
+
+        defaults:
+            parameters used by every configuration unless it overrides
+            them, e.g. positive_fitness=False, max_fitness=0
+
+        """
+        self.genetic_alphabet = genetic_alphabet
+        self.eval_func = eval_func
+        self.processes = processes
+        self.concurrency = concurrency
+        self.defaults = defaults
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def run(self, configurations, seeds=(0, 1, 2)):
+        """Run every configuration once per random seed
+
+        Returns a list of (configuration, [Run, ...]) in the order of
+        configurations. A Run reached its target if the final fitness meets
+        max_fitness; runtime is wall time, which grows with the number of
+        runs sharing the pool, so generations and evaluations are also kept.
+        A run stopped by an exception (e.g. from eval_func or the pool) has
+        it in error and never counts as reached.
+        """
+        jobs = [(index, configuration, seed)
+                for index, configuration in enumerate(configurations)
+                for seed in seeds]
+        runs = [[] for configuration in configurations]
+
+        with concurrent.futures.ProcessPoolExecutor(self.processes) as pool, \
+             concurrent.futures.ThreadPoolExecutor(self.concurrency or max(len(jobs), 1)) as runner:
+            futures = [(index, runner.submit(self._run_one, pool, configuration, seed))
+                       for index, configuration, seed in jobs]
+            for index, future in futures:
+                runs[index].append(future.result())
+
+        return list(zip(configurations, runs))
+
+    def _run_one(self, pool, configuration, seed):
+        params = dict(self.defaults)
+        params.update(configuration)
+        run_params = dict((name, params.pop(name)) for name in RUN_PARAMETERS if name in params)
+        attributes = dict((name, params.pop(name)) for name in ATTRIBUTES if name in params)
+
+        evaluator = SharedEvaluator(self.eval_func, pool, self.cache, self.lock)
+        GA = GeneticAlgorithm(self.genetic_alphabet, evaluator, random_seed=seed, **params)
+        for name, value in attributes.items():
+            setattr(GA, name, value)
+        GA.run(verbose=False, **run_params)
+
+        target = run_params.get("max_fitness")
+        fitness = GA.best.fitness
+        if target is None or GA.error is not None:
+            reached = False
+        elif GA.positive_fitness:
+            reached = fitness >= target
+        else:
+            reached = fitness <= target
+        return Run(seed, reached, GA.runtime, GA.generations,
+                   evaluator.evaluations, fitness, GA.best.s, GA.error)
+
+
+def summarize(runs):
+    """Return time-to-target statistics for the runs of one configuration
+
+    Returns a dict with the success rate, the number of runs that failed
+    with an exception and, over successful runs only, (min, median, mean,
+    max) of runtime, generations and evaluations.
+    """
+    hits = [run for run in runs if run.reached]
+    failed = [run for run in runs if run.error is not None]
+    summary = {"runs": len(runs), "reached": len(hits), "failed": len(failed),
+               "success_rate": len(hits) / len(runs) if runs else 0,
+               "error": failed[0].error if failed else None}
+    for field in ("runtime", "generations", "evaluations"):
+        values = [getattr(run, field) for run in hits]
+        if values:
+            summary[field] = (min(values), statistics.median(values),
+                              statistics.mean(values), max(values))
+        else:
+            summary[field] = None
+    return summary
+
+
+def report(results):
+    """Return a printable time-to-target report for the results of Sweep.run"""
+    lines = []
+    for configuration, runs in results:
+        summary = summarize(runs)
+        lines.append("%r" % configuration)
+        lines.append("\treached target: %d/%d" % (summary["reached"], summary["runs"]))
+        if summary["failed"]:
+            lines.append("\tfailed: %d/%d, e.g. %r" % (summary["failed"], summary["runs"],
+                                                       summary["error"]))
+        for field, unit in (("runtime", "s"), ("generations", ""), ("evaluations", "")):
+            if summary[field] is not None:
+                lines.append("\t%s: min %.5g%s, median %.5g%s, mean %.5g%s, max %.5g%s" %
+                             (field, summary[field][0], unit, summary[field][1], unit,
+                              summary[field][2], unit, summary[field][3], unit))
+    return "\n".join(lines)